@@ -0,0 +1,170 @@
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import meta
+
+log = meta.log
+
+
+class TrackCache(object):
+    """cache of completed audio streams on disk.
+
+    Streams are keyed by the request the server sends in the strm
+    headers. Only requests that name the content are cached: streams
+    proxied by the server use the same request for every track
+    (/stream.mp3?player=<mac>) and are never cached, neither are ranged
+    requests (seeks and resumes), see key().
+    Completed streams are stored as files in directory, hits are
+    returned memory mapped. When the cache grows beyond maxsize bytes the
+    least recently used streams are removed.
+
+    stats holds hits, misses, bytes_saved (bytes played from the cache
+    instead of the network, see played()) and evictions.
+    """
+    def __init__(self, directory, maxsize=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = collections.OrderedDict()  # key: size, oldest first
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load()
+
+    @staticmethod
+    def key(host, port, headers):
+        """cache key of a stream request, None if the request does not
+        identify the complete content. Only the request line and the Host
+        header count, the other headers change between players and requests"""
+        lines = headers.split(b'\r\n')
+        request = lines[0]
+        if b' /stream.' in request or b'player=' in request:
+            return None  # proxied by the server, same request for every track
+        if any(line.lower().startswith(b'range:') for line in lines[1:]):
+            return None  # a seek, the stream starts somewhere in the track
+        host_header = [line for line in lines[1:] if line.lower().startswith(b'host:')]
+        data = ('%s:%d ' % (host, port)).encode('ascii') + request + b''.join(host_header)
+        return hashlib.sha1(data).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pcm')
+
+    def load(self):
+        """pick up streams of an earlier run, least recently used first"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))  # interrupted write
+            elif name.endswith('.pcm'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name[:-len('.pcm')], stat.st_size))
+        for mtime, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def get(self, key):
+        """a read only mmap of the cached stream or None"""
+        if key not in self.entries:
+            self.stats['misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        path = self.path(key)
+        os.utime(path, None)  # keep lru order for the next run
+        with open(path, 'rb') as f:
+            result = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stats['hits'] += 1
+        log.debug('cache hit %s, %d bytes' % (key, len(result)))
+        return result
+
+    def played(self, size):
+        """size bytes of a cached stream were played"""
+        self.stats['bytes_saved'] += size
+
+    def writer(self, key):
+        """a CacheWriter to store a stream while it is received"""
+        return CacheWriter(self, key)
+
+    def add(self, key, filename):
+        """move a completed stream into the cache"""
+        size = os.path.getsize(filename)
+        if not size or size > self.maxsize:
+            os.remove(filename)
+            return
+        os.replace(filename, self.path(key))
+        if key in self.entries:
+            self.size -= self.entries.pop(key)
+        self.entries[key] = size
+        self.size += size
+        log.debug('cached %s, %d bytes' % (key, size))
+        self.evict()
+
+    def evict(self):
+        """remove least recently used streams until we fit into maxsize"""
+        while self.size > self.maxsize and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.stats['evictions'] += 1
+            log.debug('evicting %s from cache' % key)
+            try:
+                os.remove(self.path(key))
+            except OSError as e:
+                log.warning('could not remove %s: %s' % (key, e))
+
+
+class CacheWriter(object):
+    """collect a stream into a temporary file, commit() adds it to the
+    cache, abort() drops it (incomplete streams are never cached)"""
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        fd, self.filename = tempfile.mkstemp(suffix='.tmp', dir=cache.directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self, length):
+        """add the stream if it has the expected length (Content-Length)"""
+        if self.size != length:
+            log.debug('not caching %s, got %d of %s bytes' % (self.key, self.size, length))
+            self.abort()
+            return
+        self._file.close()
+        self.cache.add(self.key, self.filename)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.filename)
+
+
+if __name__ == '__main__':
+    # fill a small cache and show lru eviction
+    import shutil
+    logging.basicConfig(level=logging.DEBUG)
+    directory = tempfile.mkdtemp()
+    cache = TrackCache(directory, maxsize=3000)
+    assert TrackCache.key('127.0.0.1', 9000, b'GET /stream.mp3?player=00:01 HTTP/1.0\r\n') is None
+    assert TrackCache.key('127.0.0.1', 9000, b'GET /music/0/download HTTP/1.0\r\nRange: bytes=1000-\r\n') is None
+    keys = [TrackCache.key('127.0.0.1', 9000, b'GET /music/%d/download HTTP/1.0\r\n' % i) for i in range(5)]
+    for key in keys[:3]:
+        writer = cache.writer(key)
+        writer.write(b'\0' * 1000)
+        writer.commit(1000)
+    cache.get(keys[0])  # 0 is now the most recently used
+    writer = cache.writer(keys[3])
+    writer.write(b'\0' * 1000)
+    writer.commit(1000)  # evicts 1
+    writer = cache.writer(keys[4])
+    writer.write(b'\0' * 500)
+    writer.commit(1000)  # truncated, not cached
+    cached = [cache.get(key) is not None for key in keys]
+    log.info('cached: %s' % cached)
+    assert cached == [True, False, True, True, False]
+    log.info(cache.stats)
+    shutil.rmtree(directory)
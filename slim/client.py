@@ -1,16 +1,27 @@
 import re
 import logging
+import random
 import socket
-import time
 import struct
+import threading
+import time
 import meta
 from discover import SlimDiscovery
+from display import SlimDisplay
 from message import SlimServerMessage, Helo, Bye, Stat
+from pcm import PcmFormat, UNITY_GAIN
+from stream import SlimStream, SlimCachedStream
+from sync import StartScheduler, jiffies
+from visu import SlimVisualizer
 import util
 
 log = meta.log
 
 
+class ConnectionLost(socket.error):
+    """the control connection to the server failed"""
+
+
 class SlimClient(object):
     """
     A client for slimdevices media server
@@ -28,36 +39,72 @@ class SlimClient(object):
     mac = meta.mac
     hostid = meta.hostid
     wifichannels = 0b0000011111111111  # US default channellist 0 to 11
+    reconnect_flag = 0x4000  # in wifichannels, tells the server we reconnect
     language = b'en'
     buffersize = 1024
+    reconnect_delay = 0.5  # first backoff in seconds, doubles every attempt
+    reconnect_delay_max = 30
+    max_timeouts = 3  # consider the connection dead after this many timeouts
 
-    def __init__(self, host, port=meta.SLIMPORT):
+    def __init__(self, host, port=meta.SLIMPORT, output=None, cache=None):
+        """
+        :param output: a pcm.PcmOutput to play pcm streams, without output
+            streams are not fetched
+        :param cache: a cache.TrackCache, repeated streams are played from it
+        """
         self.host = host
         self.port = port
         self.connection = None
-        self.bytesreceived = 0
         self.timeout = 10  # expect at least a stat package every ten seconds
+        self.display = SlimDisplay()
+        self.output = output
+        self.visualizer = SlimVisualizer(self.visualizer_frame)
+        if output:
+            output.visualizer = self.visualizer
+        self.stream = None
+        self.cache = cache
+        self.scheduler = StartScheduler()  # synchronized starts, see scheduler.stats
+        self.resume_timer = None  # end of a timed pause
+        self.__sendlock = threading.Lock()  # the stream thread sends status too
         self.__terminate = False
+        self.__introduced = False  # a helo was sent before, the next one is a reconnect
 
     def connect(self):
         if self.is_connected():
             log.debug('already connected')
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connection.settimeout(self.timeout)
-        self.connection.connect((self.host, self.port))
+        try:
+            self.connection.connect((self.host, self.port))
+        except socket.error as e:
+            raise ConnectionLost('can not connect: %s' % e)
         log.debug('connected to %s:%d' % (self.host, self.port))
 
+    def disconnect(self):
+        if self.connection:
+            self.connection.close()
+        self.connection = None
+
     def is_connected(self):
         return self.connection is not None
 
+    @property
+    def bytesreceived(self):
+        """bytes of the current audio stream received so far"""
+        return self.stream.bytesreceived if self.stream else 0
+
+    def backoff(self, attempt):
+        """seconds to wait before reconnect attempt, exponential with full
+        jitter so players do not come back all at once after a server restart"""
+        # cap the exponent, pow would overflow after a long outage
+        delay = min(self.reconnect_delay * pow(2, min(attempt, 16)), self.reconnect_delay_max)
+        return random.uniform(0, delay)
+
     def get_jiffies(self):
         """a monotonic increasing number with a resolution of 1khz"""
-        # we will use current time since epoche * 1000
-        # but we need to rebase so it fits into 32bit long
-        # we module divide it by max int and use the remainder
-        # this will wrap at some point, but should be ok
-        MAX = pow(2, 32)  # make pep8 happy and do not use **
-        return int((time.time() * 1000) % MAX)
+        # the monotonic clock, so jiffies sent by the server for
+        # synchronized starts can be scheduled on the same clock
+        return jiffies()
 
     def dump(self, data, prefix=""):
         # log a hexdump
@@ -67,22 +114,33 @@ class SlimClient(object):
 
     def send(self, data):
         self.dump(data, prefix="sending ")
-        self.connection.sendall(data)
+        with self.__sendlock:
+            if not self.connection:
+                raise ConnectionLost('not connected')
+            try:
+                self.connection.sendall(data)
+            except socket.error as e:
+                raise ConnectionLost('send failed: %s' % e)
 
     def receive(self, length):
         """wait for length bytes of data.
         raises timeout error
-        raises no data error"""
+        raises ConnectionLost"""
         result = b''
         while length > 0:
-            data = self.connection.recv(min(length, self.buffersize))
+            try:
+                data = self.connection.recv(min(length, self.buffersize))
+            except socket.timeout:
+                raise
+            except socket.error as e:
+                raise ConnectionLost('receive failed: %s' % e)
             if len(data) == 0:
-                raise socket.error('no data received. socket read error')
+                raise ConnectionLost('no data received. socket read error')
             length -= len(data)
             result += data
         self.dump(result, prefix="received: ")
         if length < 0:
-            raise socket.error('too much data received')
+            raise ConnectionLost('too much data received')
         return result
 
     def receive_message(self):
@@ -96,10 +154,35 @@ class SlimClient(object):
         return message
 
     def run(self):
-        """connect to slimserver, introduce self and wait for commands"""
-        self.connect()
-        self.action_helo()
+        """connect to slimserver, introduce self and wait for commands.
+        When the connection drops reconnect with backoff, a running
+        stream keeps playing meanwhile. Other errors, of a sink or the
+        cache for example, are not a reason to reconnect"""
+        attempt = 0
+        while not self.__terminate:
+            try:
+                self.connect()
+                self.action_helo(reconnect=self.__introduced)
+                self.__introduced = True
+                attempt = 0
+                if self.stream:
+                    self.stream.report_unreported()
+                if self.receive_loop():
+                    self.action_bye()
+                    return
+            except ConnectionLost as e:
+                self.disconnect()
+                delay = self.backoff(attempt)
+                attempt = attempt + 1
+                log.warning('connection to %s:%d lost (%s), reconnect in %.1fs' % (
+                    self.host, self.port, e, delay))
+                time.sleep(delay)
+
+    def receive_loop(self):
+        """wait for commands. returns True when done, False on terminate.
+        raises ConnectionLost when the connection is lost"""
         i = 200
+        timeouts = 0
         while True:
             try:
                 message = self.receive_message()
@@ -107,14 +190,16 @@ class SlimClient(object):
                 # no data from server
                 log.debug("timeout waiting for message")
                 if self.__terminate:
-                    return
-                else:
-                    continue
+                    return False
+                timeouts = timeouts + 1
+                if timeouts >= self.max_timeouts:
+                    raise ConnectionLost('no message from server for %ds' % (timeouts * self.timeout))
+                continue
+            timeouts = 0
             self.handle_message(message)
             i = i - 1
             if i < 0:
-                break
-        self.action_bye()
+                return True
 
     def quit(self):
         """set terminate flag. """
@@ -147,52 +232,145 @@ class SlimClient(object):
             data = Bye().pack(upgrade=False)
             try:
                 self.send(data)
-            except socket.timeout:
-                pass  # ignore timeout, the server might have gone
-        self.connection = None
+            except ConnectionLost:
+                pass  # the server might have gone
+        self.disconnect()
 
-    def action_helo(self):
-        """tell the server who we are"""
+    def action_helo(self, reconnect=False):
+        """tell the server who we are.
+        On reconnect the server uses bytesreceived to resume the stream"""
+        wifichannels = self.wifichannels
+        if reconnect:
+            wifichannels = wifichannels | self.reconnect_flag
         data = Helo().pack(
             self.deviceid,
             self.revision,   # firmware version
             self.mac,
             self.hostid,
-            self.wifichannels,   # unsigned short = two bytes
+            wifichannels,   # unsigned short = two bytes
             self.bytesreceived,  # unsigned long long = 8 bytes
             self.language,
         )
         # EXTEND: also send capabilities information in HELO
         self.send(data)
 
-    def action_stmt(self, timestamp=0):
-        """report status information to the server"""
+    def action_stat(self, event_code, timestamp=0):
+        """report status information to the server.
+        raises ConnectionLost when not connected"""
+        elapsed = self.output.elapsed if self.output else 0
         fields = Stat()
-        fields['event_code'] = b'STMt'
+        fields['event_code'] = event_code
         fields['crlf'] = 0
         fields['mas_initialized'] = b'0'
         fields['mas_mode'] = b'0'
-        fields['buffer_size'] = 0
-        fields['buffer_fill'] = 0
-        fields['bytes_received'] = 0
+        fields['buffer_size'] = self.output.buffersize if self.output else 0
+        fields['buffer_fill'] = self.output.buffered if self.output else 0
+        fields['bytes_received'] = self.bytesreceived
         fields['signal_strength'] = 100
         fields['jiffies'] = self.get_jiffies()
         fields['output_buffer_size'] = 0
         fields['output_buffer_fill'] = 0
-        fields['elapsed_seconds'] = 0
+        fields['elapsed_seconds'] = int(elapsed)
         fields['voltage'] = 0
-        fields['elapsed_milliseconds'] = 0
+        fields['elapsed_milliseconds'] = int(elapsed * 1000)
         fields['server_timestamp'] = timestamp
         fields['error_code'] = 0
         self.send(fields.pack())
 
+    def action_stmt(self, timestamp=0):
+        """heartbeat, answer to strm t"""
+        self.action_stat(b'STMt', timestamp)
+
+    def action_stream(self, message):
+        """start fetching the stream described by a strm s message.
+        A ranged request continuing the current stream resumes it, the
+        output keeps playing what it has"""
+        offset = 0
+        match = re.search(br'Range: *bytes=(\d+)-', message['headers'], re.IGNORECASE)
+        if match:
+            offset = int(match.group(1))
+        if self.stream and offset and offset == self.stream.bytesreceived:
+            log.info('resuming stream at byte %d' % offset)
+            self.stream.stop()
+        else:
+            self.action_stop()
+            offset = 0
+        if message['server_ip']:
+            host = socket.inet_ntoa(struct.pack('! I', message['server_ip']))
+        else:
+            host = self.host  # same as the control connection
+        threshold = 0
+        if not offset:
+            autostart = message['autostart'] in (b'1', b'3')
+            self.output.configure(PcmFormat.from_strm(message), autostart)
+            if not autostart:
+                # the server waits for STMl before it unpauses (sync groups)
+                threshold = (message['threshold'] & 0xff) * 1024
+                threshold = max(1, min(threshold, self.output.buffersize))
+        writer = None
+        key = None
+        if self.cache and not offset:
+            key = self.cache.key(host, message['server_port'], message['headers'])
+        if key:
+            data = self.cache.get(key)
+            if data is not None:
+                self.stream = SlimCachedStream(data, self.output, self.action_stat,
+                                               self.cache, threshold)
+                self.stream.start()
+                return
+            writer = self.cache.writer(key)
+        self.stream = SlimStream(host, message['server_port'], message['headers'],
+                                 self.output, self.action_stat, offset, writer, threshold)
+        self.stream.start()
+
+    def action_stop(self):
+        """stop a running stream"""
+        self.cancel_start()
+        if self.output:
+            self.output.flush()
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
+
     ### Message Handlers
 
     def handle_aude(self, message):
         log.debug(str(message))
 
     def handle_audg(self, message):
-        log.debug(str(message))
+        """set the digital gain of the output"""
+        if not self.output:
+            return
+        if message['digitalvolumecontrol']:
+            self.output.set_gain(message['new_left'], message['new_right'])
+        else:
+            self.output.set_gain(UNITY_GAIN, UNITY_GAIN)
+
+    def handle_grfe(self, message):
+        """draw a bitmap into the display framebuffer"""
+        region = self.display.update(message['data'], message['offset'])
+        if region:
+            self.display_changed(region)
+
+    def handle_grfb(self, message):
+        """set display brightness"""
+        region = self.display.set_brightness(message['brightness'])
+        if region:
+            self.display_changed(region)
+
+    def display_changed(self, region):
+        """called with (left, top, right, bottom) of the part of the
+        display that changed. Overwrite to render self.display"""
+        log.debug('display changed in %s' % (region, ))
+
+    def handle_visu(self, message):
+        """enable or disable a visualizer"""
+        self.visualizer.configure(message['which'], message.params())
+
+    def visualizer_frame(self, which, values):
+        """called at most visualizer.framerate times a second with the
+        levels of visualizer type which. Overwrite to render them"""
+        log.debug('visualizer %d: %s' % (which, values.tolist()))
 
     def handle_setd(self, message):
         log.debug(str(message))
@@ -207,6 +385,78 @@ class SlimClient(object):
     def handle_strm_t(self, message):
         self.action_stmt(message['replay_gain'])
 
+    def handle_strm_s(self, message):
+        """start a new stream, only pcm is supported"""
+        if not self.output:
+            log.info('no output, ignoring stream')
+            return
+        if message['mode'] != b'p':
+            log.warning('unsupported stream format %s' % message['mode'])
+            self.action_stat(b'STMn')  # decoder not supported
+            return
+        try:
+            self.action_stream(message)
+        except ConnectionLost:
+            raise
+        except (ValueError, OSError) as e:
+            # unknown pcm codes, a sink or the cache failed
+            log.warning('can not play stream: %s' % e)
+            self.action_stat(b'STMn')  # decoder not supported
+
+    def handle_strm_q(self, message):
+        """stop playback"""
+        self.action_stop()
+        self.action_stat(b'STMf')  # flushed
+
+    def action_start(self):
+        """start or resume the output"""
+        self.output.start()
+        try:
+            self.action_stat(b'STMr')  # resumed
+        except ConnectionLost as e:
+            log.debug('could not report resume: %s' % e)  # runs in a timer thread
+
+    def action_pause(self):
+        """pause the output"""
+        self.output.pause()
+        self.action_stat(b'STMp')  # paused
+
+    def cancel_start(self):
+        """cancel a scheduled start or the end of a timed pause"""
+        self.scheduler.cancel()
+        if self.resume_timer:
+            self.resume_timer.cancel()
+            self.resume_timer = None
+
+    def handle_strm_u(self, message):
+        """unpause, replay_gain holds the jiffies to start at (sync groups)"""
+        if not self.output:
+            return
+        self.cancel_start()
+        if message['replay_gain']:
+            self.scheduler.schedule(message['replay_gain'], self.action_start)
+        else:
+            self.action_start()
+
+    def handle_strm_p(self, message):
+        """pause, replay_gain holds an optional interval in milliseconds
+        after which playback continues"""
+        if not self.output:
+            return
+        self.cancel_start()
+        if message['replay_gain']:
+            # not a synchronized start, keep it out of the scheduler stats
+            self.output.pause()
+            self.resume_timer = threading.Timer(message['replay_gain'] / 1000.0, self.action_start)
+            self.resume_timer.daemon = True
+            self.resume_timer.start()
+        else:
+            self.action_pause()
+
+    def handle_strm_f(self, message):
+        """flush the buffers"""
+        self.handle_strm_q(message)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -7,6 +7,38 @@ import meta
 
 log = meta.log
 
+"""
+tags of the extended (TLV) discovery, see Slim/Networking/Discovery.pm
+NAME servername
+IPAD ip address of the server
+JSON port of the json rpc interface
+VERS server version
+UUID server uuid
+"""
+TLV_TAGS = (b'NAME', b'IPAD', b'JSON', b'VERS', b'UUID')
+
+
+def pack_tlv(tag, value=b''):
+    """4 bytes tag, 1 byte length, value (at most 255 bytes)"""
+    value = value[:255]
+    return struct.pack('4s B', tag, len(value)) + value
+
+
+def unpack_tlv(data):
+    """parse a sequence of TLVs (without the leading 'e' or 'E').
+    returns a dictionary tag: value, truncated entries are dropped"""
+    result = {}
+    position = 0
+    while position + 5 <= len(data):
+        tag, length = struct.unpack_from('4s B', data, position)
+        position += 5
+        if position + length > len(data):
+            log.debug('truncated tlv %s' % tag)
+            break
+        result[tag] = bytes(data[position:position + length])
+        position += length
+    return result
+
 
 class SlimDiscovery(object):
     deviceid = meta.deviceid
@@ -14,11 +46,20 @@ class SlimDiscovery(object):
     mac = meta.mac
     buffersize = 1024
 
-    def __init__(self, port=meta.SLIMPORT):
+    def __init__(self, port=meta.SLIMPORT, extended=False):
+        """
+        :param extended: send a TLV discovery ('e') asking for TLV_TAGS
+            instead of the old 'd' request
+        """
         self.port = port
+        self.extended = extended
+        self.servers = {}  # (ip, port): dict of tlv values of the last reply
 
     def pack(self):
         """byte pack a discovery package, see Slim/Networking/Discovery.pm"""
+        if self.extended:
+            # 'e' followed by the tags we want to know, with empty values
+            return b'e' + b''.join(pack_tlv(tag) for tag in TLV_TAGS)
         # 18bytes
         # 1 byte - 'd' - discovery
         # 1 byte - ? - reserved
@@ -39,7 +80,10 @@ class SlimDiscovery(object):
     def unpack(self, data):
         """unpack a reply package. see Slim/Networking/Discovery.pm
         As we send version 4 as firmware, we expect a D + 17char hostname.
+        A TLV reply is an E followed by TLVs, see unpack_tlv.
         Function returns unicode string hostname or None if wrong data"""
+        if data[:1] == b'E':
+            return str(unpack_tlv(data[1:]).get(b'NAME', b''), 'utf-8', 'replace') or None
         try:
             (packtype, hostname) = struct.unpack('c17s', data)
         except:
@@ -49,12 +93,14 @@ class SlimDiscovery(object):
             log.debug('not a discovery reply: %s' % data)
             return None
         else:
-            return str(hostname, 'utf-8').rstrip('\0')
+            return str(hostname, 'utf-8', 'replace').rstrip('\0')
 
-    def find(self, singleshot=True, timeout=10):
+    def find(self, singleshot=True, timeout=10, address='<broadcast>'):
         """find slim server on the subnet via broadcast.
+        TLV replies are stored in self.servers.
         @param singleshot, return first who answers, otherwise wait for more replies
         @param timeout, timeout to wait for reply/replies
+        @param address, where to send the request
         @return list of [ ((ip, port), name) ]"""
         result = []
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -62,7 +108,7 @@ class SlimDiscovery(object):
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.settimeout(timeout)
         log.debug('sending discovery broadcast')
-        s.sendto(self.pack(), (('<broadcast>', self.port)))
+        s.sendto(self.pack(), ((address, self.port)))
         log.debug('waiting for discovery reply')
         try:
             while True:
@@ -71,6 +117,8 @@ class SlimDiscovery(object):
                 name = self.unpack(data)
                 if name:
                     log.debug('found host %s:%s named %s' % (ip, port, name))
+                    if data[:1] == b'E':
+                        self.servers[(ip, port)] = unpack_tlv(data[1:])
                     result.append(((ip, port), name))
                 else:
                     log.debug('package ignored')
@@ -78,10 +126,144 @@ class SlimDiscovery(object):
                     break
         except socket.timeout:
             pass
+        s.close()
         log.info('slim discovery: %s' % result)
         return result
 
+
+class SlimDiscoveryResponder(object):
+    """answer discovery requests of players, the server side of SlimDiscovery.
+
+    Replies are encoded once and cached per request, players repeat the
+    same request. The cache is dropped when the server data changes.
+    """
+    buffersize = 1024
+    timeout = 1  # check the terminate flag every second
+    cachesize = 64  # requests carry player ids (JVID), do not grow forever
+
+    def __init__(self, name, port=meta.SLIMPORT, address='',
+                 json=meta.WEBPORT, version='7.9.0', uuid=None):
+        """
+        :param name: servername
+        :param port: udp port to listen on
+        :param address: address to bind to and report as IPAD
+        """
+        self.port = port
+        self.address = address
+        self.info = {}
+        self.replies = {}
+        self.socket = None
+        self.__terminate = False
+        self.update(name=name, json=json, version=version, uuid=uuid)
+
+    def update(self, name=None, json=None, version=None, uuid=None):
+        """change the server data, None keeps the current value"""
+        values = {
+            b'NAME': name,
+            b'IPAD': self.address or None,
+            b'JSON': json,
+            b'VERS': version,
+            b'UUID': uuid,
+        }
+        for tag, value in values.items():
+            if value is not None:
+                self.info[tag] = str(value).encode('utf-8')
+        self.replies = {}  # re-encode on the next request
+
+    def pack_legacy(self):
+        """D + hostname padded to 17 bytes"""
+        return struct.pack('c17s', b'D', self.info[b'NAME'][:16])
+
+    def pack_extended(self, request):
+        """E + a TLV for every requested tag we know"""
+        result = [b'E']
+        for tag in unpack_tlv(request):
+            if tag in self.info:
+                result.append(pack_tlv(tag, self.info[tag]))
+            else:
+                log.debug('unknown discovery tag %s' % tag)
+        return b''.join(result)
+
+    def reply(self, data):
+        """the reply for a request or None if it is not a discovery request"""
+        data = bytes(data)
+        result = self.replies.get(data)
+        if result is not None:
+            return result
+        if data[:1] == b'd':
+            result = self.pack_legacy()
+        elif data[:1] == b'e':
+            result = self.pack_extended(data[1:])
+        else:
+            log.debug('not a discovery request: %s' % data)
+            return None
+        if len(self.replies) >= self.cachesize:
+            self.replies = {}
+        self.replies[data] = result
+        return result
+
+    def bind(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.settimeout(self.timeout)
+        self.socket.bind((self.address, self.port))
+        log.debug('discovery responder listening on %s:%d' % (self.address, self.port))
+
+    def run(self):
+        """answer requests until quit is called"""
+        if not self.socket:
+            self.bind()
+        while not self.__terminate:
+            try:
+                (data, address) = self.socket.recvfrom(self.buffersize)
+            except socket.timeout:
+                continue
+            result = self.reply(data)
+            if result:
+                log.debug('discovery reply to %s:%d' % address)
+                self.socket.sendto(result, address)
+        self.socket.close()
+        self.socket = None
+
+    def quit(self):
+        """set terminate flag. """
+        self.__terminate = True
+
+
 if __name__ == '__main__':
+    import sys
+    import threading
     logging.basicConfig(level=logging.DEBUG)
-    disco = SlimDiscovery()
-    log.info(disco.find(singleshot=False))
+    if sys.argv[1:] == ['loopback']:
+        # answer our own requests on the loopback interface
+        responder = SlimDiscoveryResponder('loopback', address='127.0.0.1', uuid='test')
+        responder.bind()
+        thread = threading.Thread(target=responder.run)
+        thread.start()
+        server = ('127.0.0.1', responder.port)
+        try:
+            for extended in (False, True, True):
+                disco = SlimDiscovery(extended=extended)
+                result = disco.find(timeout=2, address='127.0.0.1')
+                assert result == [(server, 'loopback')], result
+                if extended:
+                    assert disco.servers[server] == {
+                        b'NAME': b'loopback',
+                        b'IPAD': b'127.0.0.1',
+                        b'JSON': str(meta.WEBPORT).encode('ascii'),
+                        b'VERS': b'7.9.0',
+                        b'UUID': b'test',
+                    }, disco.servers
+            assert len(responder.replies) == 2  # one d and one e reply, cached
+            responder.update(name='renamed')
+            result = SlimDiscovery(extended=True).find(timeout=2, address='127.0.0.1')
+            assert result == [(server, 'renamed')], result
+            # a malformed name does not break discovery
+            assert SlimDiscovery().unpack(b'E' + pack_tlv(b'NAME', b'\xff\xfe')) == '\ufffd\ufffd'
+        finally:
+            responder.quit()
+            thread.join()
+        log.info('loopback discovery ok')
+    else:
+        disco = SlimDiscovery()
+        log.info(disco.find(singleshot=False))
@@ -0,0 +1,116 @@
+import logging
+import numpy
+import meta
+
+log = meta.log
+
+
+class SlimDisplay(object):
+    """framebuffer of a graphical display (squeezebox2 and later)
+
+    The server sends grfe messages with a bitmap in column-major order.
+    Every column is height / 8 bytes, the most significant bit of the
+    first byte is the top pixel. The bits are unpacked with numpy into a
+    persistent boolean framebuffer of shape (height, width).
+
+    After every update the framebuffer is compared with the previous
+    frame, update() returns the bounding box of the changed pixels so
+    consumers only have to redraw that region.
+    """
+    width = 320
+    height = 32
+    max_brightness = 4
+
+    def __init__(self, width=None, height=None):
+        if width:
+            self.width = width
+        if height:
+            self.height = height
+        self.bytes_per_column = self.height // 8
+        self.frame = numpy.zeros((self.height, self.width), dtype=numpy.bool_)
+        self.previous = numpy.zeros_like(self.frame)
+        self.brightness = self.max_brightness
+        self.frames = 0
+
+    def update(self, data, offset=0):
+        """unpack column-major bitmap data into the framebuffer.
+        :param data: the bitmap bytes of a grfe message
+        :param offset: byte offset into the framebuffer
+        :return: changed region as (left, top, right, bottom), right and
+            bottom exclusive, or None if nothing changed
+        """
+        start = offset // self.bytes_per_column
+        columns = min(len(data) // self.bytes_per_column, self.width - start)
+        if columns <= 0:
+            log.debug('grfe without visible columns (offset %d, %d bytes)' % (offset, len(data)))
+            return None
+        raw = numpy.frombuffer(data, dtype=numpy.uint8, count=columns * self.bytes_per_column)
+        # one row of bits per column, msb first is top to bottom
+        bits = numpy.unpackbits(raw.reshape(columns, self.bytes_per_column), axis=1)
+        numpy.copyto(self.previous, self.frame)
+        self.frame[:, start:start + columns] = bits.T
+        self.frames += 1
+        return self.changed()
+
+    def changed(self):
+        """bounding box of the pixels that differ from the previous frame"""
+        diff = self.frame != self.previous
+        rows = numpy.flatnonzero(diff.any(axis=1))
+        if not len(rows):
+            return None
+        cols = numpy.flatnonzero(diff.any(axis=0))
+        return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+    def set_brightness(self, brightness):
+        """set brightness, -1 turns the display off.
+        :return: the full display as changed region if the
+            brightness changed, otherwise None
+        """
+        brightness = max(-1, min(brightness, self.max_brightness))
+        if brightness == self.brightness:
+            return None
+        self.brightness = brightness
+        return (0, 0, self.width, self.height)
+
+    def image(self, region=None):
+        """the framebuffer as 8bit grayscale scaled by brightness
+        :param region: optional (left, top, right, bottom) to crop
+        """
+        level = 255 * max(self.brightness, 0) // self.max_brightness
+        frame = self.frame
+        if region:
+            left, top, right, bottom = region
+            frame = frame[top:bottom, left:right]
+        return frame.astype(numpy.uint8) * numpy.uint8(level)
+
+    def text(self, region=None):
+        """render the framebuffer as text, for debugging"""
+        frame = self.image(region)
+        return '\n'.join(''.join('#' if pixel else '.' for pixel in row) for row in frame)
+
+
+if __name__ == '__main__':
+    # act as server: build grfe/grfb messages and feed them through
+    # the message factory into a display
+    from message import SlimServerMessage, Grfe, Grfb
+    logging.basicConfig(level=logging.INFO)
+    display = SlimDisplay()
+    bitmap = numpy.zeros((display.height, display.width), dtype=numpy.bool_)
+    bitmap[4:12, 10:30] = True  # a block
+    data = numpy.packbits(bitmap.T, axis=1).tobytes()
+    for frame in (data, data):
+        packed = Grfe().pack(offset=0, transition=b'c', param=0, data=frame)
+        message = SlimServerMessage.factory(packed)
+        region = display.update(message['data'], message['offset'])
+        log.info('changed region %s' % (region, ))
+        assert region in ((10, 4, 30, 12), None)
+    # change a single column using the offset
+    column = numpy.packbits(numpy.ones((1, display.height), dtype=numpy.bool_), axis=1).tobytes()
+    packed = Grfe().pack(offset=100 * display.bytes_per_column, transition=b'c', param=0, data=column)
+    message = SlimServerMessage.factory(packed)
+    region = display.update(message['data'], message['offset'])
+    log.info('changed region %s' % (region, ))
+    assert region == (100, 0, 101, display.height)
+    message = SlimServerMessage.factory(Grfb().pack(brightness=2))
+    log.info('brightness region %s' % (display.set_brightness(message['brightness']), ))
+    print(display.text((0, 0, 110, display.height)))
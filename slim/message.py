@@ -153,7 +153,7 @@ class SlimMessage(object):
         :param kwargs: values as keywords in arbitary order. Missing fields will be None
         """
         if args:
-            values = args
+            values = list(args)
         elif kwargs:
             # construct values in correct order
             values = []
@@ -164,7 +164,9 @@ class SlimMessage(object):
         if self._has_variable_field():
             # the variable_field is always the last, remove it from the list
             # (so struct.pack is happy) and convert it to byte array
-            variable_field_value = bytearray(values.pop(), 'ascii')
+            variable_field_value = values.pop()
+            if not isinstance(variable_field_value, (bytes, bytearray)):
+                variable_field_value = bytearray(variable_field_value, 'ascii')
         else:
             variable_field_value = b''
         binarydata = struct.pack(self.format_string(), *values)
@@ -246,6 +248,7 @@ class SlimClientMessage(SlimMessage):
     commands names are uppercase
     """
     header_size = 8
+    header_structure = ['command:4s', 'length:I']
 
     @classmethod
     def name_from_data(cls, data):
@@ -268,6 +271,7 @@ class SlimServerMessage(SlimMessage):
     command names are lowercase
     """
     header_size = 6
+    header_structure = ['length:H', 'command:4s']
 
     @classmethod
     def name_from_data(cls, data):
@@ -422,3 +426,39 @@ class Setd(SlimServerMessage):
         'pref_id:B',
         'value:*',  # might need further parsing
     ]
+
+
+class Grfe(SlimServerMessage):
+    """bitmap for the graphical display. The payload is the framebuffer
+    in column-major order, each column is display height / 8 bytes, the
+    most significant bit is the top pixel.
+    offset is a byte offset into the framebuffer."""
+    structure = [
+        'offset:H',
+        'transition:c',
+        'param:B',
+        'data:*',
+    ]
+
+
+class Grfb(SlimServerMessage):
+    """brightness of the graphical display, -1 turns it off"""
+    structure = [
+        'brightness:h',
+    ]
+
+
+class Visu(SlimServerMessage):
+    """enable a visualizer. which is the type (0 none, 1 vu meter,
+    2 spectrum analyzer), followed by count parameters of four bytes
+    each, see params()"""
+    structure = [
+        'which:B',
+        'count:B',
+        'data:*',
+    ]
+
+    def params(self):
+        """the parameters as list of integers"""
+        data = self['data'][:self['count'] * 4]
+        return list(struct.unpack('! %dI' % (len(data) // 4), data))
@@ -3,6 +3,7 @@ import uuid
 import struct
 
 SLIMPORT = 3483
+WEBPORT = 9000  # webinterface and json rpc
 
 log = logging.getLogger('slim')
 
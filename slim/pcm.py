@@ -0,0 +1,336 @@
+import logging
+import subprocess
+import threading
+import time
+import wave
+import numpy
+import meta
+
+log = meta.log
+
+"""
+PCM output stage.
+
+The strm message describes raw pcm data with single characters,
+see Slim/Player/Squeezebox2.pm:pcmSampleSizes and friends.
+Blocks are decoded into left-aligned int32 samples, the channel
+layout is converted, the digital gain is applied and the result is
+encoded into the output format. All steps work on whole blocks with
+numpy, there is no python code per sample.
+"""
+SAMPLE_SIZES = {b'0': 1, b'1': 2, b'2': 3, b'3': 4}
+SAMPLE_RATES = {
+    b'0': 11025, b'1': 22050, b'2': 32000, b'3': 44100, b'4': 48000,
+    b'5': 8000, b'6': 12000, b'7': 16000, b'8': 24000, b'9': 96000,
+    b':': 88200, b';': 176400, b'<': 192000, b'=': 352800, b'>': 384000,
+}
+CHANNELS = {b'1': 1, b'2': 2}
+ENDIAN = {b'0': '>', b'1': '<'}
+
+UNITY_GAIN = 0x10000  # gains are 16.16 fixed point
+
+
+class PcmFormat(object):
+    """sample width in bytes, sample rate, number of channels
+    and endianness ('<' or '>') of raw pcm data"""
+    def __init__(self, width=2, rate=44100, channels=2, endian='<'):
+        self.width = width
+        self.rate = rate
+        self.channels = channels
+        self.endian = endian
+
+    @classmethod
+    def from_strm(cls, message):
+        """the pcm format of a strm message, '?' (self describing) falls
+        back to the defaults. Raises ValueError for unknown codes, playing
+        with a wrong rate or width would only produce noise"""
+        result = cls()
+        fields = (
+            ('width', 'pcm_sample_size', SAMPLE_SIZES),
+            ('rate', 'pcm_sample_rate', SAMPLE_RATES),
+            ('channels', 'pcm_channels', CHANNELS),
+            ('endian', 'pcm_endian', ENDIAN),
+        )
+        for attribute, key, codes in fields:
+            code = message[key]
+            if code in codes:
+                setattr(result, attribute, codes[code])
+            elif code != b'?':
+                raise ValueError('unsupported %s %s' % (key, code))
+        return result
+
+    @property
+    def frame_size(self):
+        """bytes per frame (one sample for every channel)"""
+        return self.width * self.channels
+
+    @property
+    def byte_rate(self):
+        """bytes per second"""
+        return self.frame_size * self.rate
+
+    def decode(self, data):
+        """raw bytes (whole frames) into an int32 array of shape
+        (frames, channels). Samples are left-aligned, the most significant
+        byte of every width ends up in the most significant byte of the int32.
+        8bit pcm is unsigned (as in wav), wider samples are signed"""
+        shift = 32 - 8 * self.width
+        if self.width in (2, 4):
+            samples = numpy.frombuffer(data, dtype='%si%d' % (self.endian, self.width))
+            samples = samples.astype(numpy.int32) << shift
+        else:
+            raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, self.width)
+            if self.endian == '>':
+                raw = raw[:, ::-1]
+            if self.width == 1:
+                raw = raw ^ numpy.uint8(0x80)  # unsigned to signed
+            padded = numpy.zeros((len(raw), 4), dtype=numpy.uint8)
+            padded[:, 4 - self.width:] = raw
+            samples = padded.view('<i4').ravel()
+        return samples.reshape(-1, self.channels)
+
+    def encode(self, samples):
+        """left-aligned int32 samples of shape (frames, channels) into bytes"""
+        if self.width in (2, 4):
+            samples = samples >> (32 - 8 * self.width)
+            return samples.astype('%si%d' % (self.endian, self.width)).tobytes()
+        raw = samples.astype('<i4').view(numpy.uint8).reshape(-1, 4)[:, 4 - self.width:]
+        if self.endian == '>':
+            raw = raw[:, ::-1]
+        if self.width == 1:
+            raw = raw ^ numpy.uint8(0x80)  # signed to unsigned
+        return raw.tobytes()
+
+    def __str__(self):
+        return '<PcmFormat %dbit %dHz %dch %s>' % (
+            self.width * 8, self.rate, self.channels,
+            'little' if self.endian == '<' else 'big')
+
+
+class WavSink(object):
+    """write pcm data into a wav file. Wav is always little endian,
+    PcmOutput converts to the endianness of a sink"""
+    endian = '<'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def open(self, pcmformat):
+        if pcmformat.endian != '<':
+            raise ValueError('wav files need little endian data, got %s' % pcmformat)
+        self.close()
+        self._file = wave.open(self.filename, 'wb')
+        self._file.setnchannels(pcmformat.channels)
+        self._file.setsampwidth(pcmformat.width)
+        self._file.setframerate(pcmformat.rate)
+
+    def write(self, data):
+        self._file.writeframesraw(data)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class PipeSink(object):
+    """write pcm data into a file object, or into the stdin of a command.
+    :param target: a writeable binary file object or a command as list,
+        the command is started when the sink is opened
+    """
+    def __init__(self, target):
+        self.target = target
+        self._process = None
+        self._file = None
+
+    def open(self, pcmformat):
+        self.close()
+        if isinstance(self.target, (list, tuple)):
+            log.debug('starting %s for %s' % (self.target, pcmformat))
+            self._process = subprocess.Popen(self.target, stdin=subprocess.PIPE)
+            self._file = self._process.stdin
+        else:
+            self._file = self.target
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self._process:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+        elif self._file:
+            self._file.flush()
+        self._file = None
+
+
+class PcmOutput(object):
+    """convert pcm blocks into an output format and write them to a sink.
+
+    :param sink: a WavSink, PipeSink or anything with open(format),
+        write(data) and close(). A sink with an endian attribute gets
+        data in that byte order
+    :param pcmformat: the output format (width, channels and endianness),
+        None keeps the input format
+
+    While paused converted blocks are buffered, start() writes the buffer
+    to the sink. Writers call wait() to hold off once buffersize input
+    bytes are buffered.
+    """
+    buffersize = 2 * 1024 * 1024
+
+    def __init__(self, sink, pcmformat=None):
+        self.sink = sink
+        self.output_format = pcmformat
+        self.input_format = None
+        self.format = None
+        self.gain = numpy.array([UNITY_GAIN, UNITY_GAIN], dtype=numpy.int64)
+        self.frames = 0
+        self.visualizer = None  # a visu.SlimVisualizer fed with every block
+        self.playing = threading.Event()
+        self.playing.set()
+        self.buffered = 0  # input bytes buffered while paused
+        self._buffer = []  # (converted data, frames)
+        self._lock = threading.Lock()
+        self._discard = False
+        self._pending = b''
+
+    def configure(self, input_format, autostart=True):
+        """start a new stream of input_format and (re)open the sink
+        :param autostart: play right away, otherwise wait for start()
+        """
+        self.input_format = input_format
+        self.format = input_format
+        if self.output_format:
+            # no resampling, the rate always follows the input
+            self.format = PcmFormat(self.output_format.width, input_format.rate,
+                                    self.output_format.channels, self.output_format.endian)
+        endian = getattr(self.sink, 'endian', None)
+        if endian and endian != self.format.endian:
+            self.format = PcmFormat(self.format.width, self.format.rate,
+                                    self.format.channels, endian)
+        if input_format.channels != self.format.channels and 1 not in (input_format.channels, self.format.channels):
+            raise ValueError('can not convert %d to %d channels' % (
+                input_format.channels, self.format.channels))
+        self._pending = b''
+        self._discard = False
+        self._clear()
+        self.frames = 0
+        log.debug('pcm output %s -> %s' % (input_format, self.format))
+        self.sink.open(self.format)
+        if autostart:
+            self.start()
+        else:
+            self.pause()
+
+    def start(self):
+        """start or resume playing, writes what was buffered while paused"""
+        with self._lock:
+            for data, frames in self._buffer:
+                self.sink.write(data)
+                self.frames += frames
+            self._clear()
+            self.playing.set()
+
+    def pause(self):
+        """pause, following writes are buffered"""
+        with self._lock:
+            self.playing.clear()
+
+    def flush(self):
+        """drop all data until the next configure, releases a blocked write"""
+        with self._lock:
+            self._discard = True
+            self._pending = b''
+            self._clear()
+            self.playing.set()
+
+    def _clear(self):
+        self._buffer = []
+        self.buffered = 0
+
+    def set_gain(self, left, right):
+        """set 16.16 fixed point gain for left and right channel"""
+        self.gain = numpy.array([left, right], dtype=numpy.int64)
+
+    @property
+    def elapsed(self):
+        """seconds of audio written"""
+        if not self.format:
+            return 0.0
+        return float(self.frames) / self.format.rate
+
+    def convert(self, data):
+        """convert a block of whole input frames to the output format"""
+        samples = self.input_format.decode(data)
+        if self.visualizer:
+            self.visualizer.feed(samples)
+        channels = self.format.channels
+        if samples.shape[1] != channels:
+            if samples.shape[1] == 1:
+                samples = numpy.repeat(samples, channels, axis=1)
+            else:
+                samples = (samples.astype(numpy.int64).sum(axis=1) // samples.shape[1])
+                samples = samples.reshape(-1, 1)
+        if (self.gain != UNITY_GAIN).any():
+            samples = (samples.astype(numpy.int64) * self.gain[:channels]) >> 16
+            samples = numpy.clip(samples, -2 ** 31, 2 ** 31 - 1)
+        return self.format.encode(samples.astype(numpy.int32))
+
+    def write(self, data):
+        """convert and write a block, partial frames are kept for the next block"""
+        if self._discard:
+            return
+        if self._pending:
+            data = self._pending + data
+        frame_size = self.input_format.frame_size
+        remainder = len(data) % frame_size
+        if remainder:
+            self._pending = data[-remainder:]
+            data = data[:-remainder]
+        else:
+            self._pending = b''
+        if not data:
+            return
+        converted = self.convert(data)
+        frames = len(data) // frame_size
+        with self._lock:
+            if self._discard:
+                return
+            if self.playing.is_set():
+                self.sink.write(converted)
+                self.frames += frames
+                return
+            self._buffer.append((converted, frames))
+            self.buffered += len(data)
+
+    def wait(self, timeout=None):
+        """wait until the buffer has room again (playing or flushed).
+        Returns False on timeout, so the writer can check if it should stop"""
+        with self._lock:
+            full = not self.playing.is_set() and self.buffered >= self.buffersize
+        return not full or self.playing.wait(timeout)
+
+    def close(self):
+        self.sink.close()
+
+
+if __name__ == '__main__':
+    # measure conversion speed against real time
+    import io
+    logging.basicConfig(level=logging.DEBUG)
+    source = PcmFormat(width=3, rate=48000, channels=2, endian='>')
+    target = PcmFormat(width=2, rate=48000, channels=2, endian='<')
+    output = PcmOutput(PipeSink(io.BytesIO()), target)
+    output.configure(source)
+    output.set_gain(UNITY_GAIN // 2, UNITY_GAIN // 3)
+    seconds = 60
+    block = numpy.random.randint(0, 256, size=source.byte_rate // 10, dtype=numpy.uint8).tobytes()
+    start = time.perf_counter()
+    for i in range(seconds * 10):
+        output.write(block)
+    duration = time.perf_counter() - start
+    log.info('converted %.1fs of %s to %s in %.3fs, %.0fx real time' % (
+        output.elapsed, source, target, duration, output.elapsed / duration))
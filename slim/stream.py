@@ -0,0 +1,174 @@
+import socket
+import threading
+import meta
+
+log = meta.log
+
+
+class SlimStream(threading.Thread):
+    """fetch an audio stream over http and feed it into an output.
+
+    The server sends the complete http request in the strm headers,
+    it is sent as is. The response headers are skipped, the body is
+    written to the output in blocks.
+
+    Progress is reported by calling callback with the status event
+    codes a player sends to the server (STMc, STMh, STMs, STMd, STMu).
+    """
+    buffersize = 4096
+    timeout = 10
+    poll = 0.5  # seconds between checks for stop while the output is full
+    # without these the server waits forever (buffer loaded, track ended)
+    required_events = (b'STMl', b'STMd', b'STMu')
+
+    def __init__(self, host, port, headers, output, callback=None, offset=0, writer=None, threshold=0):
+        """
+        :param offset: bytes already received, when resuming with a ranged request
+        :param writer: a cache.CacheWriter, a stream received completely is cached
+        :param threshold: send STMl (buffer loaded) once this many bytes are
+            received, or at the end of a shorter stream. 0 never sends it
+        """
+        threading.Thread.__init__(self, name='slimstream')
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.headers = headers
+        self.output = output
+        self.callback = callback
+        self.bytesreceived = offset
+        self.writer = writer
+        self.threshold = threshold
+        self.length = None  # Content-Length of the response
+        self.unreported = []  # required events that could not be sent
+        self.failed = False  # the stream broke before its end
+        self._connection = None
+        self._stopped = False
+
+    def event(self, code):
+        log.debug('stream event %s' % code)
+        if self.callback:
+            try:
+                self.callback(code)
+            except socket.error as e:
+                # the control connection is down, keep playing
+                log.warning('could not report %s: %s' % (code, e))
+                # a server restart breaks the stream too, after the reconnect
+                # the server resumes it, it must not be told the track ended
+                if code in self.required_events and not self.failed:
+                    self.unreported.append(code)
+
+    def report_unreported(self):
+        """send the required events lost while the control connection
+        was down, called after the helo of a reconnect"""
+        unreported, self.unreported = self.unreported, []
+        for code in unreported:
+            self.event(code)
+
+    def stop(self):
+        """stop streaming, returns after the thread has ended"""
+        self._stopped = True
+        if self._connection:
+            try:
+                self._connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass  # already closed
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def read_headers(self):
+        """read the http response headers, returns body data received with them"""
+        data = b''
+        while b'\r\n\r\n' not in data:
+            block = self._connection.recv(self.buffersize)
+            if not block:
+                raise socket.error('connection closed while reading headers')
+            data += block
+        headers, body = data.split(b'\r\n\r\n', 1)
+        log.debug('stream headers %s' % headers)
+        for line in headers.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length' and value.strip().isdigit():
+                self.length = int(value)
+        if self.writer and b' 200 ' not in headers.split(b'\r\n', 1)[0] + b' ':
+            log.debug('not caching a partial or failed response')
+            self.writer.abort()
+            self.writer = None
+        return body
+
+    def loaded(self):
+        """tell the server the buffer threshold is reached, once"""
+        if self.threshold:
+            self.threshold = 0
+            self.event(b'STMl')
+
+    def write(self, data):
+        self.bytesreceived += len(data)
+        if self.writer:
+            self.writer.write(data)
+        if self.threshold and self.bytesreceived >= self.threshold:
+            self.loaded()  # before writing, a paused output may block
+        self.output.write(data)
+        while not self._stopped and not self.output.wait(self.poll):
+            pass  # paused with a full buffer
+
+    def run(self):
+        log.debug('streaming from %s:%d' % (self.host, self.port))
+        complete = False
+        try:
+            self._connection = socket.create_connection((self.host, self.port), self.timeout)
+            self.event(b'STMc')
+            self._connection.sendall(self.headers)
+            data = self.read_headers()
+            self.event(b'STMh')
+            if data:
+                self.write(data)
+            self.event(b'STMs')
+            while not self._stopped:
+                data = self._connection.recv(self.buffersize)
+                if not data:
+                    complete = True
+                    break
+                self.write(data)
+        except (socket.error, ValueError) as e:
+            if not self._stopped:
+                log.error('stream from %s:%d failed: %s' % (self.host, self.port, e))
+        finally:
+            if self._connection:
+                self._connection.close()
+            if self.writer:
+                if complete and not self._stopped and self.length is not None:
+                    self.writer.commit(self.length)
+                else:
+                    self.writer.abort()
+        if not self._stopped:
+            self.failed = not complete
+            self.loaded()
+            self.event(b'STMd')  # decoder is ready for the next track
+            self.event(b'STMu')  # and the output ran empty
+        log.debug('stream ended after %d bytes' % self.bytesreceived)
+
+
+class SlimCachedStream(SlimStream):
+    """play a stream from the cache, data is a memory mapped cached stream.
+    The bytes played are reported to cache.played"""
+    def __init__(self, data, output, callback=None, cache=None, threshold=0):
+        SlimStream.__init__(self, None, 0, b'', output, callback, threshold=threshold)
+        self.data = data
+        self.cache = cache
+
+    def run(self):
+        log.debug('streaming %d bytes from cache' % len(self.data))
+        self.event(b'STMh')
+        self.event(b'STMs')
+        position = 0
+        while position < len(self.data) and not self._stopped:
+            self.write(self.data[position:position + self.buffersize])
+            position = position + self.buffersize
+        self.data.close()
+        if self.cache:
+            self.cache.played(self.bytesreceived)
+        if not self._stopped:
+            self.loaded()
+            self.event(b'STMd')
+            self.event(b'STMu')
+        log.debug('cached stream ended after %d bytes' % self.bytesreceived)
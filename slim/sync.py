@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+import meta
+
+log = meta.log
+
+JIFFIES_WRAP = 2 ** 32
+
+
+def jiffies(now=None):
+    """a monotonic increasing number with a resolution of 1khz.
+    It wraps at 32bit, compare jiffies with jiffies_delta."""
+    if now is None:
+        now = time.monotonic()
+    return int(now * 1000) % JIFFIES_WRAP
+
+
+def jiffies_delta(target, current):
+    """milliseconds from current to target jiffies, negative if target
+    is in the past. Handles the wrap around"""
+    return (target - current + JIFFIES_WRAP // 2) % JIFFIES_WRAP - JIFFIES_WRAP // 2
+
+
+class StartScheduler(object):
+    """call a function at a given jiffies time.
+
+    Used by players in a sync group, the server sends every player an
+    unpause with the same jiffies time. The scheduler sleeps in a thread
+    until shortly before the target and busy waits for the rest on the
+    monotonic clock, sleep alone wakes up too late.
+
+    stats holds the achieved versus requested start times in
+    milliseconds (error = achieved - requested, positive is late).
+    """
+    spin = 0.002  # seconds of busy waiting before the target
+
+    def __init__(self):
+        self.stats = {
+            'scheduled': 0,
+            'started': 0,
+            'cancelled': 0,
+            'late': 0,  # started more than 1ms after the target
+            'last_requested': None,  # monotonic seconds
+            'last_achieved': None,
+            'last_error_ms': None,
+            'max_error_ms': 0.0,
+            'mean_error_ms': 0.0,  # mean of absolute errors
+        }
+        self._thread = None
+        self._cancel = None
+
+    def schedule(self, target, callback):
+        """call callback at target jiffies, a previous schedule is cancelled"""
+        self.cancel()
+        now = time.monotonic()
+        base = int(now * 1000)  # jiffies(now) without the wrap
+        deadline = (base + jiffies_delta(target, base % JIFFIES_WRAP)) / 1000.0
+        self.stats['scheduled'] += 1
+        log.debug('start scheduled in %.1fms' % ((deadline - now) * 1000))
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='slimsync',
+                                        args=(deadline, callback, self._cancel))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        """cancel a pending start"""
+        if self._thread and self._thread.is_alive():
+            self._cancel.set()
+            self._thread.join()
+            self.stats['cancelled'] += 1
+        self._thread = None
+
+    def _run(self, deadline, callback, cancel):
+        if cancel.wait(max(deadline - time.monotonic() - self.spin, 0)):
+            return
+        while time.monotonic() < deadline:
+            pass
+        achieved = time.monotonic()
+        callback()
+        self.record(deadline, achieved)
+
+    def record(self, requested, achieved):
+        """update the statistics with a start"""
+        stats = self.stats
+        error = (achieved - requested) * 1000
+        stats['started'] += 1
+        if error > 1:
+            stats['late'] += 1
+        stats['last_requested'] = requested
+        stats['last_achieved'] = achieved
+        stats['last_error_ms'] = error
+        stats['max_error_ms'] = max(stats['max_error_ms'], abs(error))
+        stats['mean_error_ms'] += (abs(error) - stats['mean_error_ms']) / stats['started']
+        log.info('started %.3fms after requested time' % error)
+
+
+if __name__ == '__main__':
+    # schedule some starts and report the accuracy
+    logging.basicConfig(level=logging.INFO)
+    scheduler = StartScheduler()
+    for i in range(20):
+        done = threading.Event()
+        scheduler.schedule(jiffies() + 50, done.set)
+        done.wait()
+        scheduler._thread.join()
+    log.info(scheduler.stats)
@@ -1,14 +1,42 @@
 import string
+import struct
 
 
 __printables = string.ascii_letters + string.digits + string.punctuation + ' '
 __format = '0x%04x:  ' + ('%s' * 2 + ' ') * 8 + ' ' + '%s' * 16
+# translation table for bytes.translate, unprintable bytes become a dot
+__ascii = bytes(x if chr(x) in __printables else ord('.') for x in range(256))
+__blocksize = 64 * 1024  # bytes formatted at once, a multiple of 16
 
 
-def hexlines(data, format_=__format):
+def hexlines(data, format_=None):
     """yield data in a hexformat
     0x0000:  0011 2233 4455 6677 8899 aabb ccdd eeff  .................
+
+    data can be of any size (bytes, bytearray, memoryview or mmap). It is
+    formatted in blocks, hex and ascii of a whole block are produced by
+    bytes.hex and bytes.translate, lines are slices of those.
+    A custom format_ is passed on to hexlines_format.
     """
+    if format_ is not None:
+        yield from hexlines_format(data, format_)
+        return
+    view = memoryview(data).cast('B')
+    for start in range(0, len(view), __blocksize):
+        block = view[start:start + __blocksize]
+        hexpart = block.hex(' ', -2)  # every line is 40 chars: 8 * 'xxxx '
+        asciipart = bytes(block).translate(__ascii).decode('ascii')
+        for line in range(0, len(block), 16):
+            position = line * 5 // 2
+            yield '0x%04x:  %-40s %-16s' % (
+                start + line,
+                hexpart[position:position + 40],
+                asciipart[line:line + 16])
+
+
+def hexlines_format(data, format_=__format):
+    """yield data formatted with format_, which gets the position, 16
+    hex values and 16 characters. Much slower than hexlines"""
     position = 0
     while position < len(data):
         chunk = data[position:position + 16]
@@ -24,6 +52,77 @@ def hexlines(data, format_=__format):
         position = position + 16
 
 
+def message_class(data, base):
+    """the message class of a frame. base is SlimClientMessage or
+    SlimServerMessage, depending on the direction of the frame.
+    None for frames that are too short or have no ascii command"""
+    try:
+        name = base.name_from_data(data)
+    except (struct.error, UnicodeDecodeError):
+        return None
+    candidates = [cls for cls in base.__subclasses__() if cls.name == name]
+    for cls in candidates:
+        # some messages have several structures (audg), take the one that fits
+        try:
+            cls(data)
+            return cls
+        except (ValueError, struct.error):
+            pass
+    return candidates[0] if candidates else None
+
+
+def annotate(data, cls):
+    """yield data split at the field boundaries of a message,
+    one line per field with offset, name and value in hex:
+    0x0006:  command              73 74 72 6d
+
+    :param cls: a message class, or SlimClientMessage / SlimServerMessage
+        to find the class from the command name in data
+    Variable length fields and data that does not belong to a field are
+    appended as hexlines. Frames of unknown messages only get hexlines.
+    """
+    if not hasattr(cls, 'structure'):
+        cls = message_class(data, cls)
+    if cls is None:
+        structure = ['data:*']
+    else:
+        structure = cls.header_structure + cls.structure
+    position = 0
+    for definition in structure:
+        name, formatchar = definition.split(':')
+        if formatchar == '*':
+            break
+        size = struct.calcsize('!' + formatchar)
+        if position + size > len(data):
+            break
+        yield '0x%04x:  %-20s %s' % (position, name, data[position:position + size].hex(' '))
+        position = position + size
+    else:
+        name = 'trailing'  # more data than the structure describes
+    if position < len(data):
+        yield '0x%04x:  %s' % (position, name)
+        for line in hexlines(data[position:]):
+            yield '    ' + line
+
+
 if __name__ == '__main__':
+    import os
+    import time
+    from message import SlimServerMessage, Audg
     for line in hexlines(b'hello world 12345'):
         print(line)
+    for line in annotate(Audg().pack(0, 0, 1, 255, 0x10000, 0x8000), SlimServerMessage):
+        print(line)
+    # broken frames fall back to plain hexlines
+    for frame in (b'\x00\x10au', b'\x00\x06\xff\xfe\xfd\xfc'):
+        assert list(annotate(frame, SlimServerMessage)) == ['0x0000:  data'] + [
+            '    ' + line for line in hexlines(frame)]
+    # throughput compared to the format string implementation
+    data = os.urandom(4 * 1024 * 1024)
+    assert list(hexlines(data[:100003])) == list(hexlines_format(data[:100003]))
+    for function in (hexlines_format, hexlines):
+        start = time.perf_counter()
+        for line in function(data):
+            pass
+        duration = time.perf_counter() - start
+        print('%-16s %6.1f MB/s' % (function.__name__, len(data) / duration / 1024 / 1024))
@@ -0,0 +1,156 @@
+import logging
+import time
+import numpy
+import meta
+
+log = meta.log
+
+"""visualizer types of the visu message, see Slim/Display/Squeezebox2.pm"""
+NONE = 0
+VU_METER = 1
+SPECTRUM = 2
+
+
+class SlimVisualizer(object):
+    """compute vu meter levels and spectra from the pcm played.
+
+    The output feeds every block of samples. Feeding only keeps the most
+    recent samples. The computation runs in the thread that writes the
+    audio, so it is throttled to at most framerate times a second, and
+    its errors are logged, never passed on to the audio output.
+
+    A spectrum is the mean power of a batch of hann windowed ffts over
+    the recent samples, summed into logarithmic bands.
+
+    Results are passed to callback(which, values), values is an array
+    of shape (channels, bands) in dB (bands is 2 for the vu meter:
+    rms and peak).
+    """
+    framerate = 30
+    fftsize = 512
+    batch = 4  # ffts per frame
+    bands = 16
+    floor = -96.0  # dB reported for silence
+
+    def __init__(self, callback=None, framerate=None):
+        if framerate:
+            self.framerate = framerate
+        self.callback = callback
+        self.which = NONE
+        self.channels = 2
+        self.bandwidth = 1.0  # fraction of the nyquist frequency shown
+        self.window = numpy.hanning(self.fftsize)
+        self.edges = None
+        self.frames = 0  # frames computed
+        self._recent = numpy.zeros((0, 2), dtype=numpy.int32)
+        self._next = 0.0
+
+    def configure(self, which, params):
+        """set the visualizer from the visu message.
+        spectrum params are [mono, bandwidth, preemphasis, position, width,
+        orientation, bar width, bar space, ...] for the left channel,
+        the number of bands is width / (bar width + bar space)"""
+        self.which = which
+        if which == SPECTRUM and params:
+            self.channels = 1 if params[0] else 2
+            if len(params) > 1:
+                self.bandwidth = 0.5 if params[1] else 1.0
+            if len(params) > 7 and params[6] + params[7]:
+                self.bands = max(1, params[4] // (params[6] + params[7]))
+        elif which == VU_METER and params:
+            self.channels = 1 if params[0] else 2
+        self.edges = None  # recompute on the next frame
+        self._next = 0.0
+        log.debug('visualizer %d, %d channels, %d bands' % (which, self.channels, self.bands))
+
+    def band_edges(self):
+        """fft bin boundaries of logarithmic bands, the dc bin is skipped.
+        There are at most as many bands as bins"""
+        bins = int(self.fftsize // 2 * self.bandwidth)
+        bands = min(self.bands, bins)
+        edges = numpy.geomspace(1, bins + 1, bands + 1).astype(int)
+        for i in range(1, len(edges)):
+            # every band needs at least one bin
+            edges[i] = max(edges[i], edges[i - 1] + 1)
+        return edges
+
+    def feed(self, samples):
+        """samples are left-aligned int32 of shape (frames, channels)"""
+        if self.which == NONE:
+            return
+        keep = self.fftsize * self.batch
+        if len(samples) >= keep or self._recent.shape[1] != samples.shape[1]:
+            self._recent = samples[-keep:]
+        else:
+            self._recent = numpy.concatenate((self._recent[-(keep - len(samples)):], samples))
+        now = time.monotonic()
+        if now < self._next:
+            return
+        self._next = now + 1.0 / self.framerate
+        try:
+            values = self.compute()
+        except Exception as e:
+            log.error('visualizer %d failed: %s' % (self.which, e))
+            return
+        if values is not None:
+            self.frames += 1
+            if self.callback:
+                self.callback(self.which, values)
+
+    def compute(self):
+        """a frame for the current samples, None if there are not enough"""
+        samples = self._recent.astype(numpy.float32) / 2 ** 31
+        if self.channels == 1:
+            samples = samples.mean(axis=1, keepdims=True)
+        if self.which == VU_METER:
+            if not len(samples):
+                return None
+            rms = numpy.sqrt((samples ** 2).mean(axis=0))
+            peak = numpy.abs(samples).max(axis=0)
+            return self.decibel(numpy.stack((rms, peak), axis=1))
+        if self.which == SPECTRUM:
+            windows = len(samples) // self.fftsize
+            if not windows:
+                return None
+            # (channels, windows, fftsize) and one batched fft over the last axis
+            blocks = samples[-windows * self.fftsize:].T.reshape(samples.shape[1], windows, self.fftsize)
+            power = numpy.abs(numpy.fft.rfft(blocks * self.window, axis=-1)) ** 2
+            power = power.mean(axis=1) / (self.fftsize * self.window.sum())
+            if self.edges is None:
+                self.edges = self.band_edges()
+            power = power[:, :self.edges[-1]]
+            bands = numpy.add.reduceat(power, self.edges[:-1], axis=1)
+            return self.decibel(bands, power=True)
+        return None
+
+    def decibel(self, values, power=False):
+        factor = 10 if power else 20
+        return numpy.maximum(factor * numpy.log10(numpy.maximum(values, 1e-12)), self.floor)
+
+
+if __name__ == '__main__':
+    # a 1khz sine wave, the spectrum peaks in the matching band
+    logging.basicConfig(level=logging.DEBUG)
+    rate = 44100
+    t = numpy.arange(rate) / float(rate)
+    sine = (numpy.sin(2 * numpy.pi * 1000 * t) * 2 ** 30).astype(numpy.int32)
+    samples = numpy.stack((sine, sine // 2), axis=1)
+
+    def show(which, values):
+        log.info('visualizer %d: %s' % (which, numpy.round(values, 1).tolist()))
+    visualizer = SlimVisualizer(show, framerate=1000)
+    visualizer.configure(VU_METER, [0])
+    visualizer.feed(samples)
+    visualizer.configure(SPECTRUM, [0, 0, 0, 0, 160, 0, 8, 2])
+    visualizer.feed(samples)
+    log.info('band edges %s, bin width %.0fHz' % (visualizer.edges.tolist(), float(rate) / visualizer.fftsize))
+    # more bands than fft bins
+    visualizer.configure(SPECTRUM, [0, 0, 0x10000, 0, 320, 0, 1, 0])
+    frames = visualizer.frames
+    visualizer.feed(numpy.zeros((4096, 2), dtype=numpy.int32))
+    assert visualizer.frames == frames + 1 and len(visualizer.edges) == visualizer.fftsize // 2 + 1
+    start = time.perf_counter()
+    visualizer.framerate = 30
+    for i in range(0, rate, 1024):
+        visualizer.feed(samples[i:i + 1024])
+    log.info('one second of audio in %.1fms' % ((time.perf_counter() - start) * 1000))